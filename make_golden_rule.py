@@ -1,14 +1,21 @@
 import os
 import json
-import openai
+import pickle
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from openai import AsyncOpenAI
+from tqdm.asyncio import tqdm
 from dotenv import load_dotenv
 
 load_dotenv()
-openai.api_key = os.environ.get("OPENAI_API_KEY")
 
 DATA_RAW = 'data/raw_markdown/'
 DATA_REFINED = 'data/refined_markdown/'
 OUTPUT_FILE = 'data/editing_patterns.json'
+PAIRS_CACHE_FILE = 'data/.pairs.cache.pkl'
+MAX_READ_WORKERS = 16
+MAX_CONCURRENT_REQUESTS = 20
+MAX_RETRIES = 5
 
 EDIT_CATEGORIES = [
     "構成の変更 (Reordering)",
@@ -18,20 +25,57 @@ EDIT_CATEGORIES = [
     "冗長表現の削除 (Removal of redundancy)"
 ]
 
+def load_pairs_cache():
+    try:
+        with open(PAIRS_CACHE_FILE, 'rb') as f:
+            return pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError):
+        return {}
+
+def file_signature(path):
+    st = os.stat(path)
+    return (st.st_mtime_ns, st.st_size)
+
+def read_pair(raw_path, refined_path):
+    with open(raw_path, 'r', encoding='utf-8') as f_raw, \
+         open(refined_path, 'r', encoding='utf-8') as f_refined:
+        return f_raw.read(), f_refined.read()
+
 def load_document_pairs():
-    pairs = []
+    cache = load_pairs_cache()
+    new_cache = {}
     filenames = [f for f in os.listdir(DATA_RAW) if f.endswith('.md')]
+    keys = {}
+    to_read = []
     for fname in filenames:
-        with open(os.path.join(DATA_RAW, fname), 'r', encoding='utf-8') as f_raw, \
-             open(os.path.join(DATA_REFINED, fname), 'r', encoding='utf-8') as f_refined:
-            pairs.append({
-                'filename': fname,
-                'before': f_raw.read(),
-                'after': f_refined.read()
-            })
+        raw_path = os.path.join(DATA_RAW, fname)
+        refined_path = os.path.join(DATA_REFINED, fname)
+        key = (fname, file_signature(raw_path), file_signature(refined_path))
+        keys[fname] = key
+        if key in cache:
+            new_cache[key] = cache[key]
+        else:
+            to_read.append((key, raw_path, refined_path))
+
+    with ThreadPoolExecutor(max_workers=MAX_READ_WORKERS) as ex:
+        contents = ex.map(lambda item: read_pair(item[1], item[2]), to_read)
+        for (key, _, _), content in zip(to_read, contents):
+            new_cache[key] = content
+
+    pairs = []
+    for fname in filenames:
+        before, after = new_cache[keys[fname]]
+        pairs.append({
+            'filename': fname,
+            'before': before,
+            'after': after
+        })
+    if new_cache.keys() != cache.keys():
+        with open(PAIRS_CACHE_FILE, 'wb') as f:
+            pickle.dump(new_cache, f)
     return pairs
 
-def classify_edit(pair):
+async def classify_edit(client, pair, sem):
     prompt = f"""
 あなたは、以下の「編集前」と「編集後」の文章を比較して、どの編集カテゴリに最もよく当てはまるか判断してください。
 
@@ -52,21 +96,34 @@ def classify_edit(pair):
 }}
 """
 
-    response = openai.chat.completions.create(
-        model="gpt-4-turbo-preview",
-        messages=[{"role": "user", "content": prompt}],
-        temperature=0.2
-    )
+    async with sem:
+        response = await client.chat.completions.create(
+            model="gpt-4-turbo-preview",
+            messages=[{"role": "user", "content": prompt}],
+            temperature=0.2
+        )
     return json.loads(response.choices[0].message.content.strip())
 
-def main():
+async def classify_edit_or_error(client, pair, sem):
+    try:
+        return await classify_edit(client, pair, sem)
+    except Exception as e:
+        return e
+
+async def main():
     pairs = load_document_pairs()
     patterns = {}
 
-    for idx, pair in enumerate(pairs):
-        print(f"Processing {pair['filename']} ({idx+1}/{len(pairs)})...")
+    client = AsyncOpenAI(api_key=os.environ.get("OPENAI_API_KEY"), max_retries=MAX_RETRIES)
+    sem = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    results = await tqdm.gather(
+        *[classify_edit_or_error(client, pair, sem) for pair in pairs]
+    )
+
+    for pair, edit_analysis in zip(pairs, results):
         try:
-            edit_analysis = classify_edit(pair)
+            if isinstance(edit_analysis, Exception):
+                raise edit_analysis
             category = edit_analysis['category']
             if category not in patterns:
                 patterns[category] = []
@@ -75,8 +132,8 @@ def main():
                 'filename': pair['filename'],
                 'description': edit_analysis['description'],
                 'steps': edit_analysis['steps'],
-                'example_before': pair['before'],
-                'example_after': pair['after']
+                'example_before_path': os.path.join(DATA_RAW, pair['filename']),
+                'example_after_path': os.path.join(DATA_REFINED, pair['filename'])
             })
         except Exception as e:
             print(f"Error processing {pair['filename']}: {e}")
@@ -87,4 +144,4 @@ def main():
     print("Semantic decomposition completed and editing patterns saved.")
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())
@@ -1,17 +1,41 @@
 import os
 import json
+import hashlib
+import threading
+import time
+from collections import OrderedDict
 import numpy as np
 from sentence_transformers import SentenceTransformer
+import httpx
 import openai
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
 from dotenv import load_dotenv
 
+try:
+    import simsimd
+except ImportError:
+    simsimd = None
+
 load_dotenv()
 openai.api_key = os.environ.get("OPENAI_API_KEY")
+# Shared across all requests so TCP/TLS connections to the API are kept alive and reused.
+async_client = AsyncOpenAI(
+    api_key=os.environ.get("OPENAI_API_KEY"),
+    max_retries=3,
+    timeout=30.0,
+    http_client=DefaultAsyncHttpxClient(
+        limits=httpx.Limits(max_connections=50, max_keepalive_connections=20)
+    )
+)
 
 PATTERNS_FILE = "data/editing_patterns.json"
+EMBEDDINGS_CACHE_DIR = "data/embeddings_cache"
+EMBEDDINGS_CACHE_VERSION = "4"  # Bump when the way category embeddings are computed changes
 MODEL_NAME = "sentence-transformers/paraphrase-multilingual-mpnet-base-v2"
 sentence_model = SentenceTransformer(MODEL_NAME)
 TOP_N_PATTERNS = 3  # Number of editing patterns to apply simultaneously
+ENCODE_CACHE_SIZE = 4096
+STREAM_FLUSH_INTERVAL = 0.02  # Seconds to coalesce streamed tokens before yielding them
 
 GOLDEN_RULES = """
 以下の「黄金律」を必ず守って編集してください。
@@ -34,56 +58,129 @@ def load_patterns():
     with open(PATTERNS_FILE, 'r', encoding='utf-8') as f:
         return json.load(f)
 
+def embeddings_fingerprint(patterns):
+    h = hashlib.sha256(f"{EMBEDDINGS_CACHE_VERSION}:{MODEL_NAME}".encode('utf-8'))
+    h.update(json.dumps(patterns, sort_keys=True, ensure_ascii=False).encode('utf-8'))
+    return h.hexdigest()
+
+def quantize_int8(x):
+    scales = (np.max(np.abs(x), axis=-1) / 127.0).astype(np.float32)
+    return np.round(x / scales[..., None]).astype(np.int8), scales
+
+# Returns (categories, cat_matrix, cat_scales); row i times cat_scales[i] approximates the
+# L2-normalized mean embedding of categories[i]. Rows are int8 so the scan touches 4x fewer bytes.
+def load_category_matrix(patterns):
+    key = embeddings_fingerprint(patterns)
+    matrix_path = os.path.join(EMBEDDINGS_CACHE_DIR, f"{key}.npy")
+    scales_path = os.path.join(EMBEDDINGS_CACHE_DIR, f"{key}.scales.npy")
+    categories_path = os.path.join(EMBEDDINGS_CACHE_DIR, f"{key}.json")
+    if all(os.path.exists(p) for p in (matrix_path, scales_path, categories_path)):
+        with open(categories_path, 'r', encoding='utf-8') as f:
+            categories = json.load(f)
+        return categories, np.load(matrix_path, mmap_mode='r'), np.load(scales_path)
+
+    categories = list(patterns)
+    descriptions = [e["description"] for cat in categories for e in patterns[cat]]
+    cat_idx = np.array([i for i, cat in enumerate(categories) for _ in patterns[cat]])
+    embs = sentence_model.encode(descriptions, batch_size=64, convert_to_numpy=True, normalize_embeddings=True)
+    means = np.zeros((len(categories), embs.shape[1]), dtype=np.float32)
+    np.add.at(means, cat_idx, embs)
+    means /= np.bincount(cat_idx, minlength=len(categories))[:, None]
+    means /= np.linalg.norm(means, axis=1, keepdims=True)
+    cat_matrix, cat_scales = quantize_int8(means)
+
+    os.makedirs(EMBEDDINGS_CACHE_DIR, exist_ok=True)
+    np.save(matrix_path, cat_matrix)
+    np.save(scales_path, cat_scales)
+    with open(categories_path, 'w', encoding='utf-8') as f:
+        json.dump(categories, f, ensure_ascii=False)
+    return categories, cat_matrix, cat_scales
+
+# Returns (categories, cat_matrix). Without SimSIMD the int8 rows are dequantized once here,
+# since numpy has no BLAS path for integer matmul.
 def compute_category_embeddings(patterns):
-    embeddings = {}
-    for cat, ex in patterns.items():
-        descriptions = [e["description"] for e in ex]
-        embeddings[cat] = sentence_model.encode(descriptions).mean(axis=0)
-    return embeddings
-
-def find_top_patterns(input_text, category_embeddings, top_n=TOP_N_PATTERNS):
-    input_emb = sentence_model.encode(input_text)
-    similarities = []
-    for cat, emb in category_embeddings.items():
-        similarity = np.dot(input_emb, emb) / (np.linalg.norm(input_emb) * np.linalg.norm(emb))
-        similarities.append((cat, similarity))
-    similarities.sort(key=lambda x: x[1], reverse=True)
-    return [cat for cat, _ in similarities[:top_n]]
-
-def generate_prompt(input_text, selected_categories, patterns):
-    instructions = []
-    for cat in selected_categories:
-        ex = patterns[cat][0]
-        steps = "\n".join(f"- {s}" for s in ex["steps"])
-        instructions.append(f"""
+    categories, cat_matrix, cat_scales = load_category_matrix(patterns)
+    if simsimd is None:
+        cat_matrix = cat_matrix * cat_scales[:, None]
+    return categories, cat_matrix
+
+_encode_cache = OrderedDict()
+_encode_cache_lock = threading.Lock()  # encode_cached may run on executor threads
+
+def encode_cached(text):
+    key = hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+    with _encode_cache_lock:
+        emb = _encode_cache.get(key)
+        if emb is not None:
+            _encode_cache.move_to_end(key)
+            return emb
+    emb = sentence_model.encode(text, normalize_embeddings=True).astype(np.float32)
+    emb.flags.writeable = False
+    with _encode_cache_lock:
+        _encode_cache[key] = emb
+        if len(_encode_cache) > ENCODE_CACHE_SIZE:
+            _encode_cache.popitem(last=False)
+    return emb
+
+def cosine_similarities(cat_matrix, query_emb):
+    if simsimd is None:
+        return cat_matrix @ query_emb
+    # Cosine is scale-invariant, so the int8 rows can be compared without their scales.
+    query_q, _ = quantize_int8(query_emb)
+    distances = simsimd.cdist(query_q[None, :], np.ascontiguousarray(cat_matrix), metric="cosine")
+    return 1.0 - np.asarray(distances, dtype=np.float32).ravel()
+
+def find_top_patterns(input_emb, category_embeddings, top_n=TOP_N_PATTERNS):
+    categories, cat_matrix = category_embeddings
+    similarities = cosine_similarities(cat_matrix, input_emb)
+    if top_n < len(categories):
+        idx = np.argpartition(-similarities, top_n)[:top_n]
+    else:
+        idx = np.arange(len(categories))
+    idx = idx[np.argsort(-similarities[idx])]
+    return [categories[i] for i in idx]
+
+def load_example(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return f.read()
+
+# Patterns store paths to the example markdown; files written before that inline the text.
+def example_text(ex, side):
+    if f"example_{side}" in ex:
+        return ex[f"example_{side}"]
+    return load_example(ex[f"example_{side}_path"])
+
+def build_prompt_fragment(cat, ex):
+    steps = "\n".join(f"- {s}" for s in ex["steps"])
+    return f"""
 ### 編集方針: {cat}
 {ex["description"]}
 編集手順:
 {steps}
 改善例:
 編集前:
-{ex["example_before"]}
+{example_text(ex, "before")}
 編集後:
-{ex["example_after"]}
-""".strip())
+{example_text(ex, "after")}
+""".strip()
 
-    combined_instructions = "\n\n".join(instructions)
+# Pattern entries are fixed once loaded, so each category's instructions are rendered only once.
+def build_prompt_fragments(patterns):
+    return {cat: build_prompt_fragment(cat, ex[0]) for cat, ex in patterns.items()}
 
-    prompt = f"""
-あなたは日本語の文章を推敲しています。以下の黄金律と編集方針を守って改善してください。
+PROMPT_HEADER = f"""あなたは日本語の文章を推敲しています。以下の黄金律と編集方針を守って改善してください。
 
 ## 黄金律:
 {GOLDEN_RULES}
 
 ## 編集方針:
-{combined_instructions}
-
-## 改善対象の文章:
-{input_text}
-
-改善後の文章のみを出力してください。
 """
-    return prompt.strip()
+
+def generate_prompt(input_text, selected_categories, prompt_fragments):
+    combined_instructions = "\n\n".join(prompt_fragments[cat] for cat in selected_categories)
+    return (PROMPT_HEADER + combined_instructions
+            + "\n\n## 改善対象の文章:\n" + input_text
+            + "\n\n改善後の文章のみを出力してください。")
 
 def refine_text_with_gpt4(prompt):
     response = openai.chat.completions.create(
@@ -92,3 +189,27 @@ def refine_text_with_gpt4(prompt):
         temperature=0.3
     )
     return response.choices[0].message.content.strip()
+
+async def stream_refine_text_with_gpt4(prompt):
+    stream = await async_client.chat.completions.create(
+        model="gpt-4-turbo-preview",
+        messages=[{"role": "user", "content": prompt}],
+        temperature=0.3,
+        stream=True
+    )
+    pending = []
+    last_flush = time.monotonic()
+    async for chunk in stream:
+        if not chunk.choices:
+            continue
+        pending.append(chunk.choices[0].delta.content or "")
+        now = time.monotonic()
+        if now - last_flush >= STREAM_FLUSH_INTERVAL:
+            delta = "".join(pending)
+            pending.clear()
+            last_flush = now
+            if delta:
+                yield delta
+    delta = "".join(pending)
+    if delta:
+        yield delta
@@ -1,12 +1,8 @@
-from mcp.server.fastmcp import FastMCP
-from mcp.types import TextContent, CreateMessageResult, CreateMessageRequestParams
-import json
-import uuid
+from mcp.server.fastmcp import FastMCP, Context
 import asyncio
-from typing import List, Dict, Any
-import re
-from openai import AsyncOpenAI
-import os
+import hashlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 import refine_script
 import logging
@@ -17,29 +13,61 @@ logger = logging.getLogger(__name__)
 
 load_dotenv()
 
-client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-
 mcp = FastMCP("Golden Rule Server")
 
 # Pre-load patterns and embeddings from refine_script.
 patterns = refine_script.load_patterns()
 embeddings = refine_script.compute_category_embeddings(patterns)
+prompt_fragments = refine_script.build_prompt_fragments(patterns)
+
+# Sentence encoding is CPU-bound; run it off the event loop.
+encode_executor = ThreadPoolExecutor(max_workers=2)
+
+# Cache of refined results keyed by the exact input text. Near matches are never reused,
+# since they would return the rewrite of a different text.
+CACHE_MAX_ENTRIES = 10000
+cache_fingerprint = hashlib.sha256(
+    f"{refine_script.MODEL_NAME}\n{refine_script.GOLDEN_RULES}\n{refine_script.embeddings_fingerprint(patterns)}".encode('utf-8')
+).hexdigest()
+refined_cache = OrderedDict()  # text hash -> refined text, in LRU order
+
+def cache_key(text):
+    return hashlib.sha256(f"{cache_fingerprint}\n{text}".encode('utf-8')).hexdigest()
+
+def lookup_cache(key):
+    refined = refined_cache.get(key)
+    if refined is not None:
+        refined_cache.move_to_end(key)
+    return refined
+
+def store_cache(key, refined):
+    if key in refined_cache:
+        # Concurrent misses on the same text; keep the first result.
+        refined_cache.move_to_end(key)
+        return
+    refined_cache[key] = refined
+    if len(refined_cache) > CACHE_MAX_ENTRIES:
+        refined_cache.popitem(last=False)
 
 @mcp.tool()
-async def refine_text(text: str) -> str:
-    top_categories = refine_script.find_top_patterns(text, embeddings)
-    prompt = refine_script.generate_prompt(text, top_categories, patterns)
-    return refine_script.refine_text_with_gpt4(prompt)
-
-async def handle_sampling(message: CreateMessageRequestParams) -> CreateMessageResult:
-    return CreateMessageResult(
-        role="assistant",
-        content=TextContent(type="text", text="サンプリング結果"),
-        model="gpt-4",
-        stopReason="endTurn"
-    )
-
-mcp.sampling_callback = handle_sampling
+async def refine_text(text: str, ctx: Context) -> str:
+    key = cache_key(text)
+    cached = lookup_cache(key)
+    if cached is not None:
+        return cached
+    loop = asyncio.get_running_loop()
+    query_emb = await loop.run_in_executor(encode_executor, refine_script.encode_cached, text)
+    top_categories = refine_script.find_top_patterns(query_emb, embeddings)
+    prompt = refine_script.generate_prompt(text, top_categories, prompt_fragments)
+    # Forward tokens as progress notifications so clients can render the result as it is generated.
+    parts = []
+    async for delta in refine_script.stream_refine_text_with_gpt4(prompt):
+        parts.append(delta)
+        await ctx.report_progress(len(parts), message=delta)
+    refined = "".join(parts).strip()
+    if refined:
+        store_cache(key, refined)
+    return refined
 
 if __name__ == "__main__":
     import uvicorn